@@ -14,8 +14,13 @@
 # Boston, MA 02111-1307 USA
 
 import argparse
+import bisect
 import html
+import io
+import os
 import re
+import sqlite3
+import sys
 from copy import deepcopy
 
 
@@ -31,6 +36,16 @@ class Converter:
         self.run_length = 0
         self.has_begun = False
         self.footnote_line = 0
+        self.page = 1
+        self.page_line = 0
+        # When set to a list, the parser state is recorded at the end of
+        # each line. This is used by verify().
+        self.trace = None
+        # When set to a (start, end) range of input offsets, the parser
+        # state is recorded in "fine_trace" after each character in that
+        # range instead. verify() uses this to pinpoint a divergence.
+        self.fine = None
+        self.fine_trace = []
 
         self.header_template = ['', '', '', False]
         self.footer_template = ['', '', '', False]
@@ -41,7 +56,8 @@ class Converter:
         self.foot_bof = 5
         self.lines15 = False
         self.ruler = { 'left_margin': 0, 'width': 65,
-                       'tab_stops': { (i*5, '\t')  for i in range(65//5) },
+                       'tab_stops': [ (i*5, '\t') for i in range(65//5) ],
+                       'stop_columns': [ i*5 for i in range(65//5) ],
                        'pitch': 65, 'justified': True, 'spacing': 1,
                        'proportional': False, 'dots': False }
         self.note_ruler = deepcopy(self.ruler)
@@ -57,7 +73,7 @@ class Converter:
             9:  self.w_tab,              # ^I
             10: self.linefeed,           # ^J
             11: self.pagebreak_cond,     # ^K
-            12: self.w_pagebreak_uncond, # ^L
+            12: self.pagebreak_uncond,   # ^L
             24: self.footnoteref,        # ^X
             25: self.w_hyphen,           # ^Y
             27: self.esc_seq,            # ^[
@@ -115,6 +131,7 @@ class Converter:
     def w_linefeed(self): self.write('\n')
     def w_pagebreak_cond(self, lines): pass
     def w_pagebreak_uncond(self): pass
+    def w_newpage(self, page): pass
     def w_footnoteref(self, lines, n): pass
     def w_begin_footnote(self, n): pass
     def w_end_footnote(self): pass
@@ -157,14 +174,56 @@ class Converter:
 
     def finish(self):
         """End-of-file has been reached."""
+        self.checkpoint()
         self.w_finish()
 
     def linefeed(self):
         self.w_linefeed()
+        self.endline()
+
+    def endline(self):
+        """A line has ended. Handlers that consume a ^J themselves, instead
+        of going through linefeed(), must call this as well."""
+        self.checkpoint()
         if self.footnote_line > 0:
             self.footnote_line -= 1
             if self.footnote_line == 0:
                 self.w_end_footnote()
+        else:
+            self.page_line += 1
+            if self.page_line >= self.body_lines():
+                self.newpage()
+
+    def body_lines(self):
+        """Number of lines of body text that fit onto a single page."""
+        return max(1, self.page_length - self.head_tof - self.head_margin -
+                      self.foot_margin - self.foot_bof)
+
+    def newpage(self):
+        """The current page is full or has been ended explicitly."""
+        self.page += 1
+        self.page_line = 0
+        self.w_newpage(self.page)
+
+    def tell(self):
+        """Offset of the next input byte that hasn't been read yet."""
+        return self.infile.tell() - len(self.follow_char)
+
+    def state(self):
+        """Snapshot of the parser state, as recorded in the trace."""
+        return (self.tell(), self.this_char, self.prev_char, self.run_length,
+                self.footnote_line, self.page, self.page_line)
+
+    state_names = ('offset', 'this_char', 'prev_char', 'run_length',
+                   'footnote_line', 'page', 'page_line')
+
+    def checkpoint(self):
+        if self.trace is not None:
+            self.trace.append(self.state())
+
+    def finecheckpoint(self):
+        if self.fine[0] <= self.tell() <= self.fine[1]:
+            self.fine_trace.append(self.state())
 
     def getchar(self, ignore_cr = True):
         """Get the next character from the input file.
@@ -216,6 +275,16 @@ class Converter:
         lines = self.getchar(False) - 16
         self.this_char = 11 # ^K
         self.w_pagebreak_cond(lines)
+        if self.page_line > 0 and \
+           self.page_line + lines > self.body_lines():
+            self.newpage()
+
+    def pagebreak_uncond(self):
+        self.w_pagebreak_uncond()
+        # A hard break right after the page filled up doesn't start
+        # yet another page.
+        if self.page_line > 0:
+            self.newpage()
 
     def esc_seq(self):
         """An escape sequence begins with the character ^] (27). The only
@@ -311,8 +380,14 @@ class Converter:
                 ruler += chr(c)
             r['left_margin'] = ruler.index('[')
             r['width'] = ruler.index(']') + 1 # includes left margin
-            r['tab_stops'] = { (i, '\t') if ch == '\a' else ch \
-                               for i,ch in enumerate(ruler) if ch in ('\a','#')}
+            # Tab stops are counted from the left margin, which is where
+            # each line of text starts. They are sorted, so that
+            # "stop_columns" can be searched with bisect.
+            r['tab_stops'] = [ (i - r['left_margin'],
+                                '\t' if ch == '\a' else ch)
+                               for i,ch in enumerate(ruler)
+                               if ch in ('\a','#') and i > r['left_margin'] ]
+            r['stop_columns'] = [ i for i, ch in r['tab_stops'] ]
             try:
                 r['pitch'] = (65, 78, 112, 39)[ord(ruler[r['width']])-48]
             except:
@@ -386,6 +461,7 @@ class Converter:
     def convert(self):
         """Performs the actual conversion."""
         skip = 0
+        fine = self.fine
         # Skip denotes whether to skip the next read and just use
         # what's in this_char (if a function has read ahead, say)
         while True:
@@ -399,29 +475,94 @@ class Converter:
             else:
                 self.begin()
                 skip = self.w_char(chr(self.this_char))
+            if fine:
+                self.finecheckpoint()
             if self.this_char == -1:
                 break
 
 
+class Tab:
+    """A tab inside of a DOM paragraph. The text that follows it starts at
+    "column", or for decimal tabs, has its decimal point in that column."""
+
+    __slots__ = ('column', 'decimal')
+
+    def __init__(self, column, decimal = False):
+        self.column = column
+        self.decimal = decimal
+
+    def __repr__(self):
+        return f'Tab({self.column}, {self.decimal})'
+
+
+class Indent:
+    """The indentation of a DOM paragraph. Its first line starts at column
+    "first", and all following lines start at column "rest"."""
+
+    __slots__ = ('first', 'rest')
+
+    def __init__(self, first, rest = 0):
+        self.first = first
+        self.rest = rest
+
+    def __repr__(self):
+        return f'Indent({self.first}, {self.rest})'
+
+
 class DOMConverter(Converter):
 
-    def __init__(self, name, infile, outfile):
+    def __init__(self, name, infile, outfile, pages = 0, path = None,
+                 index = None):
         Converter.__init__(self, name, infile, outfile)
+        # If "pages" is non-zero, the document is split into files of that
+        # many pages each, named after "path". The main output file then
+        # becomes an index.
+        self.pages = pages
+        self.path = path
+        # If "index" names an SQLite database, the text of all paragraphs
+        # is added to its full-text search index.
+        self.index = index
+        # Link to the current output file, as stored in the search index.
+        # Only the paragraph number has to be appended.
+        self.href = ''
         self.dom = []
         self.new_para = True
         self.indents = 0
+        # Indentation of the current paragraph, and how many of its lines
+        # have been completed.
+        self.indent = None
+        self.para_lines = 0
+        self.col = 0
         self.emptyline = True
         self.active_style = ()
+        self.tabs_used = False
+
+    def state(self):
+        dom = self.dom[-1] if self.dom else None
+        text = dom[-1] if isinstance(dom, list) and dom and \
+                          isinstance(dom[-1], str) else ''
+        return Converter.state(self) + (self.new_para, self.emptyline,
+                                        self.indents, self.col, len(self.dom),
+                                        len(text))
+
+    state_names = Converter.state_names + ('new_para', 'emptyline', 'indents',
+                                           'col', 'paragraphs', 'text_length')
 
     def w_linefeed(self):
         if self.prev_char != 30 or self.run_length < 2 and self.emptyline:
             self.add_char_to_dom('')
             self.new_para = True
-            self.idents = 0
+            self.indents = 0
+            self.indent = None
+            self.para_lines = 0
+        else:
+            self.para_lines += 1
         self.emptyline = True
+        self.col = 0
 
     def w_char(self, ch):
         self.add_char_to_dom(ch)
+        self.col += 1
         self.emptyline = False
         if self.new_para:
             self.new_para = False
@@ -450,18 +591,49 @@ class DOMConverter(Converter):
             indents += 1
         # If the sequence is terminated by a \n (10), it's an empty line so
         # we ignore it.
-        if c != 10 and self.indents == 0:
-            self.indents = indents
-            self.new_para = False
         if c == 10: # \n
+            self.col = 0
+            self.endline()
             return 0
-        else:
-            return 1
+        column = self.col
+        self.col += 1 + indents
+        if column > 0:
+            # After text, ^] and its padding are how 1stWord+ saves a tab.
+            # Tabs are expanded when they are typed, so the padding, not
+            # the current ruler, tells where the text continues. The ruler
+            # only tells whether that text sits on a decimal stop, in which
+            # case the stop is where its decimal point goes.
+            ruler = self.note_ruler if self.footnote_line else self.ruler
+            i = bisect.bisect_left(ruler['stop_columns'], self.col)
+            if i < len(ruler['stop_columns']) and \
+               ruler['tab_stops'][i][1] == '#':
+                self.add_tab_to_dom(Tab(ruler['stop_columns'][i], True))
+            else:
+                self.add_tab_to_dom(Tab(self.col))
+            if self.indents == 0:
+                self.indents = self.col
+        elif self.new_para:
+            # At the start of a paragraph, ^] and its padding indent the
+            # first line.
+            self.add_char_to_dom('')
+            self.indent = Indent(self.col)
+            self.dom[-1].append(self.indent)
+            self.indents = self.col
+        elif self.para_lines == 1:
+            # If the second line is indented as well, all following lines
+            # are. Indentation further down just reflects how 1stWord+
+            # wrapped the text.
+            if self.indent is None:
+                self.indent = Indent(0)
+                self.dom[-1].append(self.indent)
+            self.indent.rest = self.col
+        return 1
 
     def w_indent_more(self):
-        pass
+        self.col += 1
 
     def w_space(self):
+        self.col += 1
         if self.emptyline and self.this_char == 30 and self.prev_char == 30:
             self.add_char_to_dom(' ')
             self.add_char_to_dom(' ')
@@ -497,7 +669,16 @@ class DOMConverter(Converter):
         pass
 
     def w_tab(self):
-        pass
+        ruler = self.note_ruler if self.footnote_line else self.ruler
+        i = bisect.bisect_right(ruler['stop_columns'], self.col)
+        if i == len(ruler['stop_columns']):
+            # Past the last tab stop, a tab is just a space.
+            self.add_char_to_dom(' ')
+            self.col += 1
+        else:
+            self.col, kind = ruler['tab_stops'][i]
+            self.add_tab_to_dom(Tab(self.col, kind == '#'))
+        self.emptyline = False
 
     def w_pagebreak_cond(self, lines):
         pass
@@ -505,6 +686,14 @@ class DOMConverter(Converter):
     def w_pagebreak_uncond(self):
         pass
 
+    def w_newpage(self, page):
+        # Page numbers are recorded as plain integers. cleanUpDOM() moves
+        # them out of paragraphs unless they split the text.
+        if self.dom and isinstance(self.dom[-1], list):
+            self.dom[-1].append(page)
+        else:
+            self.dom.append(page)
+
     def w_footnoteref(self, lines, n):
         pass
 
@@ -517,8 +706,11 @@ class DOMConverter(Converter):
     def w_hyphen(self):
         if self.getchar() == 10:
             self.add_char_to_dom('\x1c')
+            self.col = 0
+            self.endline()
         else:
             self.add_char_to_dom('-')
+            self.col += 1
             return 1
 
     def w_begin(self):
@@ -540,6 +732,11 @@ class DOMConverter(Converter):
         if ch:
             cur_para[-1] = cur_para[-1] + self.st2unicode[ord(ch)]
 
+    def add_tab_to_dom(self, tab):
+        self.add_char_to_dom('')
+        self.dom[-1].append(tab)
+        self.tabs_used = True
+
     def add_style_to_dom(self, obj):
         self.active_style = obj
         if len(self.dom) == 0 or not isinstance(self.dom[-1], list):
@@ -553,6 +750,7 @@ class DOMConverter(Converter):
         for para in self.dom:
             if isinstance(para, list):
                 style = None
+                indent = None
                 p = []
                 for line in para:
                     if isinstance(line, str):
@@ -561,14 +759,81 @@ class DOMConverter(Converter):
                                 p.append(style)
                                 style = None
                             p.append(line)
+                    elif isinstance(line, (int, Tab)):
+                        p.append(line)
+                    elif isinstance(line, Indent):
+                        indent = line
                     elif line or p:
                         style = line
-                dom.append(p)
+                # Page breaks that don't split any text go between paragraphs.
+                trail = len(p)
+                while trail > 0 and isinstance(p[trail - 1], int):
+                    trail -= 1
+                lead = 0
+                while lead < trail and isinstance(p[lead], int):
+                    lead += 1
+                dom += p[:lead]
+                # The paragraph's indentation goes first, so that it is
+                # known before any of its text is written.
+                if indent and lead < trail:
+                    p.insert(lead, indent)
+                    trail += 1
+                dom.append(p[lead:trail])
+                dom += p[trail:]
             else:
                 dom.append(para)
+        # Don't start an empty page at the end of the document.
+        while dom and isinstance(dom[-1], int):
+            dom.pop()
         self.dom = dom
 
-    def domToHTML(self):
+    def tabLayout(self, para):
+        """Works out the grid columns for a paragraph that contains tabs.
+        Returns the CSS column template, and for each Tab whether it starts
+        a new column. Tabs that are already covered by the preceding text
+        (e.g. in paragraphs that span several lines) are rendered as spaces.
+        Returns None if none of the tabs start a new column."""
+        # Length of the text in each cell, and offset of its decimal point.
+        # That is the last '.' or ',', so that thousands separators don't
+        # throw off the alignment.
+        cells = [[0, -1]]
+        tabs = []
+        for line in para:
+            if isinstance(line, Tab):
+                cells.append([0, -1])
+                tabs.append(line)
+            elif isinstance(line, str):
+                cell = cells[-1]
+                point = max(line.rfind('.'), line.rfind(','))
+                if point >= 0:
+                    cell[1] = cell[0] + point
+                cell[0] += len(line)
+        widths = []
+        new_column = []
+        # The grid starts at the paragraph's indentation.
+        start = para[0].first if isinstance(para[0], Indent) else 0
+        end = start + cells[0][0]
+        for tab, (length, point) in zip(tabs, cells[1:]):
+            column = tab.column
+            if column >= end:
+                if tab.decimal:
+                    column = max(end, column - (length if point < 0 else point))
+                widths.append(f'{column - start}ch')
+                new_column.append(True)
+                start = column
+                end = column + length
+            else:
+                new_column.append(False)
+                end += 1 + length
+        if not widths:
+            return None
+        return ' '.join(widths) + ' 1fr', iter(new_column)
+
+    def chunkName(self, chunk):
+        stem, ext = os.path.splitext(os.path.basename(self.path))
+        return f'{stem}-{chunk}{ext or ".html"}'
+
+    def writeHead(self, title):
         self.write(
           f'<!DOCTYPE html>\n'
           f'<html>\n'
@@ -582,55 +847,151 @@ class DOMConverter(Converter):
           f'  text-align: justify;\n'
           f'  text-wrap: pretty;\n'
           f'}}\n')
-        if len(self.pitches_used) > int(65 in self.pitches_used):
-            comma = ''
-            for k, v in self.pitch2name.items():
-                if k in self.pitches_used:
-                    self.write(f'{comma}.{v} p *')
-                    comma = ', '
-            self.write(f' {{\n'
-                       f'  vertical-align: top;\n'
-                       f'}}\n');
-        if len(self.pitches_used) > int(65 in self.pitches_used):
-            comma = ''
-            for k, v in self.pitch2name.items():
-                if k in self.pitches_used:
-                    self.write(f'{comma}.{v} sub, .{v} sup')
-                    comma = ', '
-            self.write(f' {{\n'
-                       f'  vertical-align: revert;\n'
-                       f'}}\n')
-        if 78 in self.pitches_used:
+        # Other pitches squeeze or stretch the ruler's <div> horizontally.
+        # This leaves line heights untouched, so unlike a vertical scale
+        # there is nothing to compensate for after layout.
+        for k, v in self.pitch2name.items():
+            if k in self.pitches_used:
+                self.write(
+                  f'.{v} {{\n' # k chars per line
+                  f'  transform: scaleX(calc(65/{k}));\n'
+                  f'  transform-origin: 0 0;\n'
+                  f'}}\n')
+        if self.tabs_used:
             self.write(
-              f'.elite p span {{\n' # 78 chars per line
-              f'  display: inline-block;\n'
-              f'  font-size: calc(65/78*100%);\n'
-              f'  transform: scaleY(calc(78/65));\n'
-              f'  transform-origin: 0 0;\n'
+              f'p.tabs {{\n'
+              f'  display: grid;\n'
               f'}}\n')
-        if 112 in self.pitches_used:
+        if self.pages:
             self.write(
-              f'.condensed p span {{\n' # 112 chars per line
-              f'  display: inline-block;\n'
-              f'  font-size: calc(65/112*100%);\n'
-              f'  transform: scaleY(calc(112/65));\n'
-              f'  transform-origin: 0 0;\n'
-              f'}}\n')
-        if 39 in self.pitches_used:
-            self.write(
-              f'.expanded p span {{\n' # 39 chars per line
-              f'  display: inline-block;\n'
-              f'  font-size: calc(65/39*100%);\n'
-              f'  transform: scaleY(calc(39/65));\n'
-              f'  transform-origin: 0 0;\n'
+              f'nav {{\n'
+              f'  margin-block: 1em;\n'
               f'}}\n')
         self.write(
           f'</style>\n'
-          f'<title>{self.name}</title>\n'
+          f'<title>{html.escape(title)}</title>\n'
           f'</head>\n'
           f'<body>\n')
+
+    def writeTail(self):
+        self.write(f'</body>\n'
+                   f'</html>\n')
+
+    def writeIndex(self, chunks, last_page):
+        """Fills the main output file with a table of contents that links
+        to all the chunks."""
+        self.writeHead(self.name)
+        self.write(f'<h1>{html.escape(self.name)}</h1>\n'
+                   f'<ol>\n')
+        for chunk in range(1, chunks + 1):
+            first = (chunk - 1)*self.pages + 1
+            last = min(last_page, chunk*self.pages)
+            pages = f'Page {first}' if first == last \
+                    else f'Pages {first}\u2013{last}'
+            self.write(f'<li><a href="{html.escape(self.chunkName(chunk))}">'
+                       f'{pages}</a></li>\n')
+        self.write('</ol>\n')
+        self.writeTail()
+
+    def writeNav(self, chunk, chunks):
+        self.write('<nav>')
+        if chunk > 1:
+            self.write(f'<a href="{html.escape(self.chunkName(chunk - 1))}">'
+                       f'Previous</a> ')
+        self.write(f'<a href="{html.escape(os.path.basename(self.path))}">'
+                   f'Index</a>')
+        if chunk < chunks:
+            self.write(f' <a href="{html.escape(self.chunkName(chunk + 1))}">'
+                       f'Next</a>')
+        self.write('</nav>\n')
+
+    def chunkPath(self, chunk):
+        return os.path.join(os.path.dirname(self.path), self.chunkName(chunk))
+
+    def startChunk(self, chunk, chunks):
+        path = self.chunkPath(chunk)
+        if self.index:
+            self.href = self.indexPath(path) + '#p'
+        self.outfile = open(path, 'w')
+        self.pos = 0
+        self.writeHead(f'{self.name} ({chunk}/{chunks})')
+        self.writeNav(chunk, chunks)
+
+    def endChunk(self, chunk, chunks):
+        self.writeNav(chunk, chunks)
+        self.writeTail()
+        self.outfile.close()
+
+    def indexPath(self, path):
+        """Path of an output file, relative to the directory that holds the
+        search index. This identifies documents and links in the index."""
+        return os.path.relpath(path,
+                               os.path.dirname(os.path.abspath(self.index)))
+
+    def writeSearchIndex(self, document, entries):
+        """Replaces all paragraphs of "document" in the full-text search
+        index with "entries", a list of (href, page, text) tuples."""
+        # Take the write lock before looking for free rowids, so that
+        # conversions running in parallel don't pick the same ones.
+        db = sqlite3.connect(self.index, timeout = 60, isolation_level = None)
+        try:
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                db.execute('CREATE TABLE IF NOT EXISTS documents '
+                           '(name TEXT PRIMARY KEY, first INTEGER, '
+                           'last INTEGER)')
+                db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS paragraphs '
+                           'USING fts5(document UNINDEXED, href UNINDEXED, '
+                           'page UNINDEXED, text)')
+                # Each document occupies a contiguous range of rowids, so
+                # that converting it again doesn't have to scan the index.
+                old = db.execute('SELECT first, last FROM documents '
+                                 'WHERE name = ?', (document,)).fetchone()
+                if old:
+                    db.execute('DELETE FROM paragraphs '
+                               'WHERE rowid BETWEEN ? AND ?', old)
+                    db.execute('DELETE FROM documents WHERE name = ?',
+                               (document,))
+                if not entries:
+                    return
+                last = db.execute('SELECT rowid FROM paragraphs '
+                                  'ORDER BY rowid DESC LIMIT 1').fetchone()
+                first = last[0] + 1 if last else 1
+                db.executemany('INSERT INTO paragraphs '
+                               '(rowid, document, href, page, text) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               [ (first + i, document) + entry
+                                 for i, entry in enumerate(entries) ])
+                db.execute('INSERT INTO documents VALUES (?, ?, ?)',
+                           (document, first, first + len(entries) - 1))
+        finally:
+            db.close()
+
+    def domToHTML(self):
+        if self.pages:
+            last_page = 1
+            for para in self.dom:
+                if isinstance(para, int):
+                    last_page = para
+                elif isinstance(para, list):
+                    for line in para:
+                        if isinstance(line, int):
+                            last_page = line
+            chunks = (last_page - 1)//self.pages + 1
+            self.writeIndex(chunks, last_page)
+            index = self.outfile
+            chunk = 1
+            self.startChunk(chunk, chunks)
+        else:
+            if self.index:
+                self.href = self.indexPath(self.path) + '#p'
+            self.writeHead(self.name)
+        # Paragraphs are numbered for the search index, and get matching
+        # ids in the HTML.
+        entries = [] if self.index else None
+        anchor = ''
+        page = 1
         active_div = False
-        span = False
         cur_width = -1
         cur_pitch = -1
         for para in self.dom:
@@ -638,24 +999,96 @@ class DOMConverter(Converter):
                 if not para:
                     self.write('<br/>\n')
                 else:
-                    style = '' if self.ruler['justified'] \
-                            else ' style="text-align: left"'
-                    self.write(f'<p{style}>')
-                    if span: self.write('<span>')
+                    if entries is not None:
+                        n = len(entries) + 1
+                        anchor = f' id="p{n}"'
+                        entries.append((f'{self.href}{n}', page))
+                        text = []
+                    cls = ''
+                    properties = [] if self.ruler['justified'] \
+                                 else ['text-align: left']
+                    indent = para[0] if isinstance(para[0], Indent) else None
+                    first_line = ''
+                    # Paragraphs with tabs become a grid with one <span> per
+                    # column.
+                    layout = self.tabLayout(para) if self.tabs_used else None
+                    if layout:
+                        columns, new_column = layout
+                        cls = ' class="tabs"'
+                        properties.append(f'grid-template-columns: {columns}')
+                        if indent and indent.first:
+                            properties.append(
+                                f'padding-left: {indent.first}ch')
+                        cell = 0
+                    elif indent:
+                        if indent.rest:
+                            properties.append(f'padding-left: {indent.rest}ch')
+                        if indent.first != indent.rest:
+                            first_line = f'text-indent: ' \
+                                         f'{indent.first - indent.rest}ch'
+                    style = cls + (f' style="{"; ".join(properties)}"'
+                                   if properties else '')
+                    if first_line:
+                        properties.append(first_line)
+                        first_style = f'{cls} style="{"; ".join(properties)}"'
+                    else:
+                        first_style = style
+                    self.write(f'<p{anchor}{first_style}>')
+                    if layout:
+                        self.write('<span>')
                     tags = ''
+                    opening = ''
                     closing = ''
                     for line in para:
                         if isinstance(line, str):
                             if tags:
                                 self.write(tags)
+                                opening = tags
                                 tags = ''
                             self.write(
                                 re.sub(r'([\u05d0-\u05ea])', r'<span>\1</span>',
                                        html.escape(line)))
+                            if entries is not None:
+                                text.append(line)
+                        elif isinstance(line, int):
+                            page = line
+                            if not self.pages or (line - 1) % self.pages:
+                                continue
+                            # The paragraph straddles two chunks. Close all
+                            # open elements, and reopen them in the next chunk.
+                            if not tags and closing:
+                                self.write(closing)
+                                tags = opening
+                            if layout:
+                                self.write('</span>')
+                            self.write('</p>\n')
+                            if active_div:
+                                self.write('</div>\n')
+                            self.endChunk(chunk, chunks)
+                            chunk += 1
+                            self.startChunk(chunk, chunks)
+                            if active_div:
+                                self.write(div)
+                            self.write(f'<p{style}>')
+                            if layout:
+                                self.write('<span></span>'*cell + '<span>')
+                        elif isinstance(line, Indent):
+                            continue
+                        elif isinstance(line, Tab):
+                            if entries is not None:
+                                text.append(' ')
+                            if not layout or not next(new_column):
+                                self.write(' ')
+                                continue
+                            if not tags and closing:
+                                self.write(closing)
+                                tags = opening
+                            self.write('</span><span>')
+                            cell += 1
                         else:
                             if not tags and closing:
                                 self.write(closing)
-                                closing = ''
+                            closing = ''
                             tags = ''
                             if 'bold' in line:
                                 tags += '<b>'
@@ -677,46 +1110,216 @@ class DOMConverter(Converter):
                                 closing = '</sub>' + closing
                     if not tags and closing:
                         self.write(closing)
-                    if span: self.write('</span>')
+                    if layout:
+                        self.write('</span>')
                     self.write('</p>\n')
+                    if entries is not None:
+                        # Soft hyphens would split words.
+                        entries[-1] += (''.join(text).translate(
+                                          { 0xad: None, 0xa0: ' ' }),)
+            elif isinstance(para, int):
+                page = para
+                if self.pages and (para - 1) % self.pages == 0:
+                    if active_div:
+                        self.write('</div>\n')
+                    self.endChunk(chunk, chunks)
+                    chunk += 1
+                    self.startChunk(chunk, chunks)
+                    if active_div:
+                        self.write(div)
             else:
                 if para['width'] != cur_width or para['pitch'] != cur_pitch:
                     cur_width = para['width']
-                    width = cur_width*65.0/para['pitch']
                     cur_pitch = para['pitch']
                     try:
                         pitch = self.pitch2name[cur_pitch]
                         cls = f' class="{pitch}"'
-                        span = True
                     except:
                         cls = ''
-                        span = False
                     if active_div:
                         self.write('</div>\n')
                     active_div = True
-                    self.write(f'<div style="width: {width}rch;"{cls}>')
+                    div = f'<div style="width: {cur_width}rch;"{cls}>'
+                    self.write(div)
         if active_div:
             self.write('</div>\n')
-        if len(self.pitches_used) > int(65 in self.pitches_used):
-            self.write(
-            r'<script>''\n'
-            r'  for (var sp of document.getElementsByTagName("span")) {''\n'
-            r'    sp.style.marginBottom = ''\n'
-            r'      (Number(getComputedStyle(sp).transform.split(",")[3])-1)*''\n'
-            r'      sp.clientHeight + "px";''\n'
-            r'  }''\n'
-            r'</script>''\n')
-        self.write(f'</body>\n'
-                   f'</html>\n')
+        if self.pages:
+            self.endChunk(chunk, chunks)
+            self.outfile = index
+        else:
+            self.writeTail()
+        if entries is not None:
+            self.writeSearchIndex(self.indexPath(self.path), entries)
+
+
+class FastDOMConverter(DOMConverter):
+    """Produces the same DOM as DOMConverter, but reads the entire input
+    at once and hands runs of words to the DOM in one go. Only single
+    spaces between printable characters are part of these runs, as
+    w_space() simply copies them. Everything else still goes through the
+    dispatch table one character at a time, so all of the remaining
+    space handling is shared with the reference engine."""
+
+    def __init__(self, name, infile, outfile, pages = 0, path = None,
+                 index = None):
+        DOMConverter.__init__(self, name, infile, outfile, pages, path, index)
+        self.data = b''
+        self.offset = 0
+        # Anything that isn't dispatched, and isn't a CR that might have
+        # to be folded into a CRLF pair, is printable.
+        special = bytes(sorted(k for k in self.dispatch_table if k >= 0))
+        printable = b'[^\r' + re.escape(special) + b']+'
+        self.printable = re.compile(
+            printable + b'(?:[\x1e ]' + printable + b')*')
+
+    def tell(self):
+        return self.offset
+
+    def getchar(self, ignore_cr = True):
+        data = self.data
+        i = self.offset
+        if i >= len(data):
+            self.this_char = -1
+            return -1
+        c = data[i]
+        i += 1
+        if c == 13 and ignore_cr and i < len(data) and data[i] == 10:
+            c = 10
+            i += 1
+        self.offset = i
+        self.prev_char = self.this_char
+        self.this_char = c
+        if c == self.prev_char:
+            self.run_length += 1
+        else:
+            self.run_length = 0
+        return c
+
+    def w_text(self, text):
+        """Equivalent to calling w_char() for each byte in "text"."""
+        self.w_char(chr(text[0]))
+        self.col += len(text) - 1
+        if len(text) > 1:
+            para = self.dom[-1]
+            para[-1] = para[-1] + ''.join(map(self.st2unicode.__getitem__,
+                                              text[1:]))
+        # Update prev_char and run_length as getchar() would have.
+        n = len(text)
+        last = text[-1]
+        same = n - len(text.rstrip(text[-1:]))
+        if same < n:
+            self.prev_char = text[-2]
+            self.run_length = same - 1
+        else:
+            self.run_length = n - 1 + (self.run_length + 1
+                                       if last == self.this_char else 0)
+            self.prev_char = self.this_char if n == 1 else last
+        self.this_char = last
+
+    def convert(self):
+        self.data = self.infile.read()
+        self.offset = 0
+        skip = 0
+        fine = self.fine
+        while True:
+            if not skip:
+                m = self.printable.match(self.data, self.offset)
+                if m:
+                    self.begin()
+                    self.offset = m.end()
+                    self.w_text(m.group())
+                    if fine:
+                        self.finecheckpoint()
+                    continue
+                self.getchar()
+            if self.this_char in self.dispatch_table:
+                fnc = self.dispatch_table[self.this_char]
+                if fnc != self.start_format_seq:
+                    self.begin()
+                skip = fnc()
+            else:
+                self.begin()
+                skip = self.w_char(chr(self.this_char))
+            if fine:
+                self.finecheckpoint()
+            if self.this_char == -1:
+                break
 
-def convert(input_filename, output_filename):
+
+engines = { 'reference': DOMConverter, 'fast': FastDOMConverter }
+
+def convert(input_filename, output_filename, pages = 0, engine = 'reference',
+            index = None):
     with open(input_filename, 'rb') as infile, \
          open(output_filename, 'w') as outfile:
         name = (output_filename if not output_filename.startswith('/dev') \
                 else input_filename).split('/')[-1]
-        converter = DOMConverter(name, infile, outfile)
+        converter = engines[engine](name, infile, outfile, pages,
+                                    output_filename, index)
         converter.convert()
 
+def verify(input_filename, engine):
+    """Converts the input with both the reference engine and "engine",
+    and reports where they disagree. Returns True if they don't."""
+    with open(input_filename, 'rb') as infile:
+        data = infile.read()
+    name = input_filename.split('/')[-1]
+
+    def run(cls, fine = None):
+        outfile = io.StringIO()
+        converter = cls(name, io.BytesIO(data), outfile)
+        if fine:
+            converter.fine = fine
+        else:
+            converter.trace = []
+        converter.convert()
+        return converter, outfile.getvalue()
+
+    def report(a, b):
+        for n, x, y in zip(DOMConverter.state_names, a, b):
+            print(f'    {n:13} reference={x!r:8} {engine}={y!r}'
+                  f'{"" if x == y else "  <--"}')
+
+    ref, ref_html = run(DOMConverter)
+    alt, alt_html = run(engines[engine])
+    if ref.trace == alt.trace and ref_html == alt_html:
+        return True
+    print(f'{input_filename}: "{engine}" engine differs from "reference"')
+    # Find the first line that ends in a different state. Then convert
+    # again, recording the state after every character of that line, and
+    # compare at the offsets that both engines stop at.
+    start = 0
+    for i, (a, b) in enumerate(zip(ref.trace, alt.trace)):
+        if a != b:
+            fine = (start, a[0])
+            ref_states = { s[0]: s for s in
+                           run(DOMConverter, fine)[0].fine_trace }
+            alt_states = { s[0]: s for s in
+                           run(engines[engine], fine)[0].fine_trace }
+            for offset in sorted(ref_states.keys() & alt_states.keys()):
+                if ref_states[offset] != alt_states[offset]:
+                    print(f'  parser state diverges at input offset {offset} '
+                          f'(line {i + 1}):')
+                    report(ref_states[offset], alt_states[offset])
+                    break
+            else:
+                print(f'  parser state diverges at the end of line {i + 1}, '
+                      f'between input offsets {start} and {a[0]}:')
+                report(a, b)
+            break
+        start = a[0]
+    else:
+        if len(ref.trace) != len(alt.trace):
+            print(f'  reference saw {len(ref.trace)} lines, '
+                  f'{engine} saw {len(alt.trace)}')
+    i = next((i for i, (x, y) in enumerate(zip(ref_html, alt_html)) if x != y),
+             min(len(ref_html), len(alt_html)))
+    if i < max(len(ref_html), len(alt_html)):
+        print(f'  HTML output diverges at offset {i}:\n'
+              f'    reference: {ref_html[i:i+40]!r}\n'
+              f'    {engine + ":":10} {alt_html[i:i+40]!r}')
+    return False
+
 def main():
     parser = argparse.ArgumentParser(
         description='Convert Atari ST 1stWord+ files to HTML files.')
@@ -724,9 +1327,29 @@ def main():
     parser.add_argument('-f', '--force', action='store_true',
                         help="attempt conversion even if input file doesn't "
                              'appear to be in 1stWord+ format')
+    parser.add_argument('-e', '--engine', choices=engines.keys(),
+                        default='reference',
+                        help='parsing engine to use (default: reference)')
+    parser.add_argument('--verify', action='store_true',
+                        help='check that the selected engine produces the '
+                             'same result as the reference engine, before '
+                             'converting')
+    parser.add_argument('-p', '--pages', type=int, default=0, metavar='N',
+                        help='split the document into files of N pages each, '
+                             'and turn the output file into an index')
+    parser.add_argument('-i', '--index', metavar='DB',
+                        help='add the text of every paragraph to the SQLite '
+                             'full-text search index in DB, creating it if '
+                             'needed')
     parser.add_argument('input', help='1stWord+ input file')
     parser.add_argument('output', help='HTML output file')
     args = parser.parse_args()
+    if args.pages < 0:
+        parser.error('--pages must not be negative')
+    if args.pages and args.output.startswith('/dev'):
+        parser.error('--pages needs a regular output file')
+    if args.index and args.output.startswith('/dev'):
+        parser.error('--index needs a regular output file')
 
     with open(args.input, 'r', encoding='latin-1') as infile:
         firstline = infile.readline()
@@ -745,16 +1368,16 @@ def main():
             pass
         break
 
-    if recognized:
-        convert(args.input, args.output)
-    else:
-        if args.force:
-            print("{} doesn't look like a 1stWord+ file.\nConverting anyway "
-                  'since --force was specified.'.format(args.input))
-            convert(args.input, args.output)
-        else:
+    if not recognized:
+        if not args.force:
             print("Skipping {} since it doesn't look like a 1stWord+ file.\n"
                   '(Use --force to override.)'.format(args.input))
+            return
+        print("{} doesn't look like a 1stWord+ file.\nConverting anyway "
+              'since --force was specified.'.format(args.input))
+    if args.verify and not verify(args.input, args.engine):
+        sys.exit(1)
+    convert(args.input, args.output, args.pages, args.engine, args.index)
 
 
 if __name__ == '__main__':